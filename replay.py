@@ -0,0 +1,25 @@
+####################################################
+# Replays a solver query log recorded with QueryRecorder under different solver settings
+#
+# python replay.py queries.jsonl                      (default z3.Solver())
+# python replay.py queries.jsonl --tactics simplify   (SOLVER_TACTICS key)
+# python replay.py queries.jsonl --tactics simplify,propagate-values,smt
+# python replay.py queries.jsonl --cache              (answer repeated queries from a cache)
+####################################################
+
+import argparse
+from src.SymExec import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument("log")
+parser.add_argument("--tactics", default=None)
+parser.add_argument("--cache", action="store_true")
+parser.add_argument("--top", type=int, default=10)
+args = parser.parse_args()
+
+tactics = args.tactics
+if tactics is not None and tactics not in SOLVER_TACTICS:
+    tactics = tactics.split(",")
+
+report = replay_queries(args.log, tactics=tactics, cache={} if args.cache else None)
+print_replay_report(report, top=args.top)
@@ -7,6 +7,11 @@ import ast
 import z3
 from copy import deepcopy
 import logging
+import time
+import json
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from termcolor import colored
 
 logging.basicConfig(level=logging.INFO)
@@ -23,16 +28,203 @@ def reverse_body(body):
     body.reverse()
     return body
 
-def check_satisfiability(sym_state):
-    solver = z3.Solver()
+# theory used for the program variables
+# "int": unbounded z3.Int, "/" is integer division
+# "bv":  fixed width z3.BitVec (machine ints), "/" and comparisons are signed
+ENCODINGS = ("int", "bv")
+
+# tactic pipelines for the feasibility checks, None means the default z3.Solver()
+# the last tactic has to decide the goal, otherwise the check comes back as unknown
+# "bitblast" only works with the "bv" encoding
+SOLVER_TACTICS = {
+    "default": None,
+    "simplify": ["simplify", "propagate-values", "solve-eqs", "smt"],
+    "bitblast": ["simplify", "propagate-values", "solve-eqs", "bit-blast", "sat"],
+}
+
+# tactics that can only decide bit-vector goals, on Int constraints every check comes back unknown
+BV_ONLY_TACTICS = ("bit-blast", "sat", "qfbv")
+
+# the bv-only tactics in the pipeline, when it is used with a non bv encoding
+def unsupported_tactics(encoding, tactics):
+    if isinstance(tactics, str):
+        tactics = SOLVER_TACTICS.get(tactics)
+    if encoding == "bv":
+        return []
+    return [tactic for tactic in tactics or [] if tactic in BV_ONLY_TACTICS]
+
+def check_encoding_tactics(encoding, tactics):
+    if encoding not in ENCODINGS:
+        raise Exception(f"Unsupported encoding <{encoding}>, expected one of {ENCODINGS}")
+    if isinstance(tactics, str) and tactics not in SOLVER_TACTICS:
+        raise Exception(f"Unknown tactics <{tactics}>, expected a list of tactic names or one of {list(SOLVER_TACTICS)}")
+    unsupported = unsupported_tactics(encoding, tactics)
+    if unsupported:
+        raise Exception(f"Tactics {unsupported} only work with the \"bv\" encoding, not <{encoding}>")
+
+# build a solver from a list of tactic names (or a SOLVER_TACTICS key)
+# ctx: z3 context to build it in, None for the global one
+def make_solver(tactics=None, ctx=None):
+    if isinstance(tactics, str):
+        tactics = SOLVER_TACTICS[tactics]
+    if not tactics:
+        return z3.Solver(ctx=ctx)
+    if len(tactics) == 1:
+        return z3.Tactic(tactics[0], ctx=ctx).solver()
+    return z3.Then(*tactics, ctx=ctx).solver()
+
+# recorder (optional): a QueryRecorder that logs the query, tagged with the originating state id and node line
+# pooled: the check runs on a SolverPool worker, see QueryRecorder
+def check_satisfiability(sym_state, tactics=None, recorder=None, state_id=None, lineno=None, ctx=None, pooled=False):
+    solver = make_solver(tactics, ctx)
     solver.add(*sym_state)
-    return solver.check() 
+    if recorder is None:
+        return solver.check()
+    start = time.perf_counter()
+    result = solver.check()
+    recorder.record(solver, tactics, result, time.perf_counter() - start, state_id, lineno, pooled)
+    return result
+
+
+# logs every feasibility query to a jsonl file, one query per line:
+# query_id, state_id, lineno, tactics, result, time (seconds), pooled, smt2 (SMT-LIB2 dump of the query)
+# pooled queries were timed on a SolverPool worker, their time includes waiting on the other threads and the GIL
+class QueryRecorder():
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w")
+        self.n_queries = 0
+        # queries can come from the SolverPool worker threads
+        self.lock = threading.Lock()
+
+    def record(self, solver, tactics, result, elapsed, state_id=None, lineno=None, pooled=False):
+        smt2 = solver.to_smt2()
+        with self.lock:
+            self._write(smt2, tactics, result, elapsed, state_id, lineno, pooled)
+
+    def _write(self, smt2, tactics, result, elapsed, state_id, lineno, pooled):
+        entry = {
+            "query_id": self.n_queries,
+            "state_id": state_id,
+            "lineno": lineno,
+            "tactics": tactics,
+            "result": str(result),
+            "time": elapsed,
+            "pooled": pooled,
+            "smt2": smt2,
+        }
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        self.n_queries += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# runs feasibility checks on a pool of worker threads, z3 releases the GIL while solving
+# so the interpreter can keep stepping other states in the meantime
+# z3 contexts are not thread safe: the query is serialized to SMT-LIB2 on the caller's thread
+# and parsed into a per-worker context
+class SolverPool():
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.local = threading.local()
+
+    def _ctx(self):
+        if not hasattr(self.local, "ctx"):
+            self.local.ctx = z3.Context()
+        return self.local.ctx
+
+    def _check(self, smt2, tactics, recorder, state_id, lineno):
+        ctx = self._ctx()
+        sym_state = list(z3.parse_smt2_string(smt2, ctx=ctx))
+        return check_satisfiability(sym_state, tactics, recorder, state_id, lineno, ctx, pooled=True)
+
+    # same arguments as check_satisfiability, returns a future of the z3.CheckSatResult
+    def submit(self, sym_state, tactics=None, recorder=None, state_id=None, lineno=None):
+        # a throwaway z3.Solver is far more expensive to build and free than dumping the conjunction directly
+        formula = z3.And(*sym_state) if len(sym_state) > 0 else z3.BoolVal(True)
+        smt2 = z3.Z3_benchmark_to_smtlib_string(formula.ctx_ref(), "", "", "unknown", "", 0, (z3.Ast * 0)(), formula.as_ast())
+        return self.executor.submit(self._check, smt2, tactics, recorder, state_id, lineno)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def load_queries(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# re-run a recorded query log under different solver settings
+# tactics: list of z3 tactic names or a SOLVER_TACTICS key
+# cache:   optional dict, identical queries are answered from it instead of calling z3 again
+# returns one dict per query with the recorded and replayed result/time and the speedup
+def replay_queries(path, tactics=None, cache=None):
+    report = []
+    for query in load_queries(path):
+        # like the recording, only the check itself (or the cache lookup) is timed
+        if cache is not None and query["smt2"] in cache:
+            start = time.perf_counter()
+            result = cache[query["smt2"]]
+            elapsed = time.perf_counter() - start
+        else:
+            solver = make_solver(tactics)
+            solver.from_string(query["smt2"])
+            start = time.perf_counter()
+            result = str(solver.check())
+            elapsed = time.perf_counter() - start
+            if cache is not None:
+                cache[query["smt2"]] = result
+        if result != query["result"]:
+            logger.warning(f"<!>  query [{query['query_id']}] result changed: {query['result']} -> {result}")
+        report.append({
+            "query_id": query["query_id"],
+            "state_id": query["state_id"],
+            "lineno": query["lineno"],
+            "result": query["result"],
+            "replay_result": result,
+            "time": query["time"],
+            "pooled": query.get("pooled", False),
+            "replay_time": elapsed,
+            "speedup": query["time"] / elapsed if elapsed > 0 else float("inf"),
+        })
+    return report
+
+# print the replay report, slowest recorded queries first
+def print_replay_report(report, top=10):
+    total_time = sum(r["time"] for r in report)
+    total_replay = sum(r["replay_time"] for r in report)
+    print_c(f"Queries: {len(report)}, recorded: {total_time:.4f}s, replayed: {total_replay:.4f}s", "blue")
+    n_pooled = sum(1 for r in report if r["pooled"])
+    if n_pooled > 0:
+        print_c(f"Warning: {n_pooled} queries were recorded on a SolverPool, their recorded time includes thread/GIL "
+                f"contention, so the speedups below are overstated. Record without a pool to compare solver settings", "red")
+    for r in sorted(report, key=lambda r: r["time"], reverse=True)[:top]:
+        color = "green" if r["speedup"] >= 1 else "red"
+        print_c(f"\tquery {r['query_id']} (state {r['state_id']}, line {r['lineno']}) {r['result']}: "
+                f"{r['time']:.4f}s -> {r['replay_time']:.4f}s  x{r['speedup']:.2f}", color)
 
 
 # keeps track variable used
 # assigns a new postfixed z3 variable for each new assignment
 class Z3VarEnv():
-    def __init__(self):
+    def __init__(self, encoding="int", bv_width=32):
+        if encoding not in ENCODINGS:
+            raise Exception(f"Unsupported encoding <{encoding}>, expected one of {ENCODINGS}")
+        self.encoding = encoding
+        self.bv_width = bv_width
         self.env = {}
         self.z3_vars = {}
     
@@ -44,14 +236,17 @@ class Z3VarEnv():
             self.env[var] += 1
         vname = var if self.env[var]==0 else var + "_" + str(self.env[var])
         idx = self.env[var]
-        self.z3_vars[var].append(z3.Int(vname))
+        if self.encoding == "bv":
+            self.z3_vars[var].append(z3.BitVec(vname, self.bv_width))
+        else:
+            self.z3_vars[var].append(z3.Int(vname))
         return self.z3_vars[var][-1]
 
     def get_last_assigned(self, var):
         return self.z3_vars[var][-1]
 
     def copy(self):
-        new_env = Z3VarEnv()
+        new_env = Z3VarEnv(self.encoding, self.bv_width)
         new_env.env = self.env.copy()
         new_env.z3_vars = deepcopy(self.z3_vars)
         return new_env
@@ -67,7 +262,14 @@ class Z3VarEnv():
 # 3. The symbolic state, a list of z3 constraints
 # 4. The variable environment, a mapping of variable names to their z3 variables
 class SymState():
+    _ids = itertools.count()
+
     def __init__(self, tree_traversal_stack, path_taken, symbolic_state, z3_var_env):
+        self.state_id = next(SymState._ids)
+        # line of the ast node that produced this state, None for the entry state
+        self.lineno = None
+        # pending SolverPool check, see submit_satisfiability
+        self.sat_future = None
         self.tree_traversal_stack = tree_traversal_stack
         self.path_taken = path_taken
         self.symbolic_state = symbolic_state
@@ -95,12 +297,24 @@ class SymState():
         solver.add(*self.symbolic_state)
         if solver.check() == z3.sat:
             model = solver.model()
-            non_underscored_vars = {d.name(): model[d] for d in model.decls() if '_' not in d.name()}
+            # bit-vectors are printed as signed machine ints
+            non_underscored_vars = {d.name(): model[d].as_signed_long() if isinstance(model[d], z3.BitVecNumRef) else model[d]
+                                    for d in model.decls() if '_' not in d.name()}
             print_c(non_underscored_vars, "green")
         else:
             print_c("No satisfying assignment", "red")
-    def is_satisfiable(self):
-        return check_satisfiability(self.symbolic_state) == z3.sat
+    # unknown counts as satisfiable, a path is only pruned when the solver proves it infeasible
+    def is_satisfiable(self, tactics=None, recorder=None):
+        if self.sat_future is not None and not self.sat_future.cancelled():
+            result = self.sat_future.result()
+        else:
+            result = check_satisfiability(self.symbolic_state, tactics, recorder, self.state_id, self.lineno)
+        if result == z3.unknown:
+            logger.warning(f"\tSolver returned unknown for state [{self.state_id}] (line {self.lineno}), keeping the path")
+        return result != z3.unsat
+    # start the feasibility check on a SolverPool, is_satisfiable() then waits for its result
+    def submit_satisfiability(self, solver_pool, tactics=None, recorder=None):
+        self.sat_future = solver_pool.submit(self.symbolic_state, tactics, recorder, self.state_id, self.lineno)
     def is_terminated(self):
         return len(self.tree_traversal_stack) == 0
     
@@ -110,14 +324,29 @@ class SymState():
 
 class SymExec():
 
-    def __init__(self, func):
+    # encoding: one of ENCODINGS, or "auto" to benchmark the candidates on func for auto_steps steps and keep the fastest,
+    #           when tactics is given only the encodings are benchmarked, with those tactics
+    # tactics:  list of z3 tactic names or a SOLVER_TACTICS key, applied to every feasibility check
+    # recorder: optional QueryRecorder, logs every feasibility check
+    # solver_pool: optional SolverPool, new states are checked on it while the rest of the step is interpreted
+    def __init__(self, func, encoding="int", bv_width=32, tactics=None, recorder=None, solver_pool=None, auto_steps=10):
+        if encoding == "auto":
+            candidates = None
+            if tactics is not None:
+                candidates = [(enc, tactics) for enc in ENCODINGS if not unsupported_tactics(enc, tactics)]
+            encoding, tactics = pick_fastest_encoding(func, auto_steps, candidates, bv_width)[0]
+        check_encoding_tactics(encoding, tactics)
         if not isinstance(func, ast.FunctionDef) and isinstance(func, ast.Module):
             func = func.body[0]
         if not isinstance(func, ast.FunctionDef):
             raise Exception("input is not an ast.FunctionDef OR ast.Module containing a single ast.FunctionDef")
         
         self.func = func
-        var_env = Z3VarEnv()
+        self.encoding = encoding
+        self.tactics = tactics
+        self.recorder = recorder
+        self.solver_pool = solver_pool
+        var_env = Z3VarEnv(encoding, bv_width)
 
         for arg in func.args.args:
             var_env.assign_var(arg.arg)
@@ -197,7 +426,7 @@ class SymExec():
     def find_path_to_target(self, steps=10):
         self.reaching_states == []
         for i in range(steps):
-            self.step()
+            self.step(cancel_on_target=True)
             if len(self.reaching_states) > 0:
                 logger.info(f"<!>  Target reached after [{i}] steps... number of states explored: {len(self.states) + len(self.unreachable_states) + len(self.terminated_states)}")
                 return self.reaching_states
@@ -228,16 +457,23 @@ class SymExec():
         return self.explore(steps)
 
     # explore one step from the current states
-    def step(self):
+    # cancel_on_target: with a solver_pool, cancel the queued checks as soon as a target is hit and stop submitting new ones,
+    #                   the affected states stay in self.states, in order, unchecked, and are checked on the next step.
+    #                   so unlike the synchronous run, unreachable states among them are still counted as in-progress
+    def step(self, cancel_on_target=False):
         new_states = []
+        target_hit = False
 
         # process each state to generate new states
         # action differs based on the type of the ast.node
         for state in self.states:
-            logger.debug(f"processing state: {state.symbolic_state}")
-            logger.debug(f"\tNodes: {state.tree_traversal_stack}")
-            if not state.is_satisfiable():
+            # lazy formatting, printing the z3 constraints is expensive and holds the GIL
+            logger.debug("processing state: %s", state.symbolic_state)
+            logger.debug("\tNodes: %s", state.tree_traversal_stack)
+            if not state.is_satisfiable(self.tactics, self.recorder):
                 logger.warn(f"\tPath unreachable...SKIPPING")
+                # states left unchecked by a target hit (or the entry state) are only classified here
+                self.unreachable_states.append(state)
                 continue
             if state.is_terminated():
                 logger.warn(f"\tPath terminated...SKIPPING")
@@ -245,6 +481,7 @@ class SymExec():
 
             next_node = state.tree_traversal_stack.pop()
             old_env = state.z3_var_env
+            n_new_states = len(new_states)
             if isinstance(next_node, ast.Return):
                 logger.debug("Return")
                 new_env = old_env.copy()
@@ -344,6 +581,11 @@ class SymExec():
                                                     state.symbolic_state.copy(), 
                                                     state.z3_var_env.copy()))
                     self.reaching_states.append(new_states[-1])
+                    if cancel_on_target and self.solver_pool is not None:
+                        target_hit = True
+                        for pending in new_states:
+                            if pending.sat_future is not None and not pending.is_terminated():
+                                pending.sat_future.cancel()
                 else:
                     logger.debug("Unknown Call <" + next_node.func.id + "> Skipped")
                     new_states.append(  SymState(   state.tree_traversal_stack.copy(), 
@@ -353,8 +595,19 @@ class SymExec():
             else:
                 raise Exception("Unsupported AST node" + str(next_node.__class__))
 
+            for new_state in new_states[n_new_states:]:
+                new_state.lineno = next_node.lineno
+                # after a target hit only terminated states are still checked, to classify them
+                if self.solver_pool is not None and not (target_hit and not new_state.is_terminated()):
+                    new_state.submit_satisfiability(self.solver_pool, self.tactics, self.recorder)
+
+        # states whose check was cancelled or never submitted because of a target hit
+        unchecked_states = []
+        if target_hit:
+            unchecked_states = [state for state in new_states if not state.is_terminated() and (state.sat_future is None or state.sat_future.cancelled())]
+
         # filter out unreachable and terminated states
-        unreachable_states = [state for state in new_states if not state.is_satisfiable()]
+        unreachable_states = [state for state in new_states if state not in unchecked_states and not state.is_satisfiable(self.tactics, self.recorder)]
         terminated_states = [state for state in new_states if state.is_terminated() and state not in unreachable_states]
         new_states = [state for state in new_states if state not in unreachable_states and state not in terminated_states]
 
@@ -365,6 +618,61 @@ class SymExec():
         logger.debug(f"New States: {len(new_states)}")
         logger.debug(f"Unreachable States removed: {len(unreachable_states)}")
         logger.debug(f"Terminated States removed: {len(terminated_states)}")
+        logger.debug(f"Unchecked States kept: {len(unchecked_states)}")
+
+
+# (encoding, tactics) pairs tried by pick_fastest_encoding
+ENCODING_CANDIDATES = [
+    ("int", "default"),
+    ("int", "simplify"),
+    ("bv", "default"),
+    ("bv", "simplify"),
+    ("bv", "bitblast"),
+]
+
+# the plain unbounded Int run the candidates are compared against
+REFERENCE_ENCODING = ("int", "default")
+
+# explore func under one (encoding, tactics) config
+# returns the wall time and the (reaching, unreachable, terminated) counts
+def run_encoding(func, encoding, tactics, steps=10, bv_width=32):
+    # SymExec consumes the function body, work on a fresh copy each time
+    sym_exec = SymExec(deepcopy(func), encoding=encoding, bv_width=bv_width, tactics=tactics)
+    start = time.perf_counter()
+    sym_exec.explore(steps)
+    elapsed = time.perf_counter() - start
+    return elapsed, (len(sym_exec.reaching_states), len(sym_exec.unreachable_states), len(sym_exec.terminated_states))
+
+# run the same exploration under each (encoding, tactics) candidate and time it
+# the encodings are not equivalent (bit-vectors wrap around on overflow) and a candidate that prunes
+# more paths does less work, so each run is also checked against the REFERENCE_ENCODING run
+# returns the candidates sorted fastest first, as ((encoding, tactics), seconds, matches_reference)
+def benchmark_encodings(func, steps=10, candidates=None, bv_width=32):
+    if candidates is None:
+        candidates = ENCODING_CANDIDATES
+    # untimed reference run, also pays the one-time z3 startup cost so the first candidate is not penalized
+    _, reference_counts = run_encoding(func, *REFERENCE_ENCODING, steps, bv_width)
+    results = []
+    for encoding, tactics in candidates:
+        elapsed, counts = run_encoding(func, encoding, tactics, steps, bv_width)
+        matches = counts == reference_counts
+        logger.info(f"<!>  encoding [{encoding}] tactics [{tactics}]: {elapsed:.4f}s, reaching/unreachable/terminated: {counts}" + ("" if matches else f", differs from reference {reference_counts}"))
+        results.append(((encoding, tactics), elapsed, matches))
+    results.sort(key=lambda r: r[1])
+    return results
+
+# pick the fastest (encoding, tactics) for func among the candidates whose results match the reference run
+# returns ((encoding, tactics), seconds)
+def pick_fastest_encoding(func, steps=10, candidates=None, bv_width=32):
+    results = [r for r in benchmark_encodings(func, steps, candidates, bv_width) if r[2]]
+    if len(results) == 0:
+        raise Exception(f"No encoding candidate matches the {REFERENCE_ENCODING} results after [{steps}] steps")
+    (encoding, tactics), elapsed, _ = results[0]
+    logger.info(f"<!>  fastest encoding: {(encoding, tactics)}")
+    if encoding != REFERENCE_ENCODING[0]:
+        logger.warning(f"<!>  auto picked the <{encoding}> encoding, it matched the unbounded Int run for [{steps}] steps "
+                       f"but variables are now {encoding} and wrap around on overflow")
+    return (encoding, tactics), elapsed
 
 
 if __name__ == "__main__":